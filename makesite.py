@@ -41,6 +41,15 @@ import sys
 import json
 import datetime
 import collections
+import argparse
+import filecmp
+import subprocess
+import concurrent.futures
+import hashlib
+import time
+import math
+import functools
+import urllib.parse
 
 
 def fread(filename):
@@ -51,12 +60,18 @@ def fread(filename):
 
 def fwrite(filename, text):
     """Write content to file and close the file."""
+    fwrite_stream(filename, [text])
+
+
+def fwrite_stream(filename, fragments):
+    """Write fragments of content to file one by one and close the file."""
     basedir = os.path.dirname(filename)
-    if not os.path.isdir(basedir):
+    if basedir and not os.path.isdir(basedir):
         os.makedirs(basedir)
 
     with open(filename, 'w') as f:
-        f.write(text)
+        for fragment in fragments:
+            f.write(fragment)
 
 
 def log(msg, *args):
@@ -64,12 +79,87 @@ def log(msg, *args):
     sys.stderr.write(msg.format(*args) + '\n')
 
 
-def truncate(text, words=25):
-    """Remove tags and truncate text to the specified number of words."""
+# Build Cache
+# ===========
+# Directory where results of earlier builds are kept for reuse.
+_CACHE_DIR = '_cache'
+
+# Hash of this script, so that a change to the code that generates the
+# output invalidates all results cached by earlier versions.
+with open(__file__, 'rb') as f:
+    _CODE_VERSION = hashlib.sha1(f.read()).hexdigest()
+
+
+def cache_key(*values):
+    """Return a hash of JSON-serializable values for use as a cache key."""
+    data = json.dumps((_CODE_VERSION,) + values, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def read_cache(name):
+    """Read build cache with the specified name into a dictionary."""
+    path = os.path.join(_CACHE_DIR, name + '.json')
+    if not os.path.isfile(path):
+        return {}
+    try:
+        cache = json.loads(fread(path))
+    except ValueError as e:
+        log('WARNING: Ignoring corrupt cache {}: {}', path, str(e))
+        return {}
+    if cache.get('version') != _CODE_VERSION:
+        return {}
+    return cache['cache']
+
+
+def write_cache(name, cache):
+    """Write build cache with the specified name."""
+    data = {'version': _CODE_VERSION, 'cache': cache}
+    fwrite(os.path.join(_CACHE_DIR, name + '.json'), json.dumps(data))
+
+
+def cache_params(params):
+    """Return params that affect rendered output for use in a cache key."""
+    return {k: v for k, v in params.items()
+            if k not in ('site_dir', 'callback')}
+
+
+def fwrite_cached(filename, key, fragments):
+    """Write file from cached output for key or else from fragments.
+
+    Return True if the fragments had to be rendered and written.
+    """
+    cache_path = os.path.join(_CACHE_DIR, 'pages', key)
+    if os.path.isfile(cache_path):
+        fwrite_stream(filename, [])
+        shutil.copyfile(cache_path, filename)
+        os.utime(cache_path)
+        return False
+    fwrite_stream(filename, fragments)
+    fwrite_stream(cache_path, [])
+    shutil.copyfile(filename, cache_path)
+    return True
+
+
+def prune_cached(start_time):
+    """Remove cached output that has not been used since start time."""
+    for cache_path in glob.glob(os.path.join(_CACHE_DIR, 'pages', '*')):
+        # Allow for file systems with coarse timestamps.
+        if os.path.getmtime(cache_path) < start_time - 2:
+            os.remove(cache_path)
+
+
+def strip_tags(text):
+    """Remove headings, tags and TeX commands from text."""
     text = re.sub(r'(?s)<h[1-6].*?>(.*?)</h[1-6]>', '', text)
     text = re.sub(r'(?s)\\\(|\\\)|\\[|\\]|\\begin{.*?}|\\end{.*?}', '', text)
     text = re.sub(r'(?s)<.*?>', '', text)
     text = re.sub(r'(?s)\\[a-z]*?{(.*?)}', r'\1', text)
+    return text
+
+
+def truncate(text, words=25):
+    """Remove tags and truncate text to the specified number of words."""
+    text = strip_tags(text)
     text = ' '.join(text.split()[:words])
     return text
 
@@ -106,8 +196,19 @@ def simple_date(date_str):
         return d.strftime('%d %b %Y %I:%M %p GMT')
 
 
+# Parsed content files shared by all site variants generated in a run.
+_content_cache = {}
+
+
 def read_content(filename):
     """Read content and metadata from file into a dictionary."""
+    if filename not in _content_cache:
+        _content_cache[filename] = parse_content(filename)
+    return dict(_content_cache[filename])
+
+
+def parse_content(filename):
+    """Parse content and metadata from file into a dictionary."""
     # Read file content.
     text = fread(filename)
 
@@ -158,11 +259,66 @@ def read_files(src):
     return items
 
 
+_PLACEHOLDER_RE = re.compile(r'{{\s*([^}\s]+)\s*}}')
+
+
 def render(template, **params):
     """Replace placeholders in template with values from params."""
-    return re.sub(r'{{\s*([^}\s]+)\s*}}',
-                  lambda match: str(params.get(match.group(1), match.group(0))),
-                  template)
+    return _PLACEHOLDER_RE.sub(
+        lambda match: str(params.get(match.group(1), match.group(0))),
+        template)
+
+
+@functools.lru_cache(maxsize=None)
+def template_fields(template):
+    """Return sorted names of placeholders in template."""
+    return tuple(sorted(set(_PLACEHOLDER_RE.findall(template))))
+
+
+# Rendered fragments read from the last build and those used in this run.
+_fragments = {}
+_used_fragments = {}
+
+
+def render_cached(template, derived=None, **params):
+    """Render template like render() reusing fragments of earlier builds.
+
+    The derived dictionary maps placeholder names to functions that
+    compute their values from params. They are called only when the
+    fragment is not cached, so their values must depend on the content
+    param alone.
+    """
+    # Only the values of placeholders present in the template can
+    # affect the output, so the key is made of these values alone.
+    derived = derived or {}
+    fields = template_fields(template)
+    values = [params.get(name) for name in fields if name not in derived]
+    if any(name in derived for name in fields):
+        values.append(hashlib.sha1(params['content'].encode()).hexdigest())
+    key = cache_key(template, values)
+
+    text = _used_fragments.get(key)
+    if text is None:
+        text = _fragments.get(key)
+        if text is None:
+            for name in fields:
+                if name in derived:
+                    params[name] = derived[name](params)
+            text = render(template, **params)
+        _used_fragments[key] = text
+    return text
+
+
+_CONTENT_RE = re.compile(r'{{\s*content\s*}}')
+
+
+def render_stream(template, fragments, **params):
+    """Render template and yield it in pieces with fragments as content."""
+    parts = _CONTENT_RE.split(template, 1)
+    yield render(parts[0], **params)
+    if len(parts) == 2:
+        yield from fragments
+        yield render(parts[1], **params)
 
 
 def head_content(import_header, root):
@@ -182,9 +338,14 @@ def head_content(import_header, root):
     return '\n' + '\n'.join(imports)
 
 
+def site_path(params, dst_path):
+    """Return URL path of output file relative to the site root."""
+    clean_path = os.path.relpath(dst_path, params['site_dir'])
+    return clean_path.replace('index.html', '')
+
+
 def set_canonical_url(params, dst_path):
-    clean_path = dst_path.replace('_site/', '').replace('index.html', '')
-    params['canonical_url'] = params['site_url'] + clean_path
+    params['canonical_url'] = params['site_url'] + site_path(params, dst_path)
 
 
 def make_pages(src, dst, layout, **params):
@@ -215,6 +376,7 @@ def make_pages(src, dst, layout, **params):
 
         dst_path = render(dst, **page_params)
         set_canonical_url(page_params, dst_path)
+        content['site_path'] = site_path(page_params, dst_path)
         output = render(layout, **page_params)
 
         log('Rendering {} => {} ...', content['slug'], dst_path)
@@ -225,18 +387,18 @@ def make_pages(src, dst, layout, **params):
 
 def make_list(posts, dst, list_layout, item_layout, **params):
     """Generate list page for a blog."""
-    items = []
-    for post in posts:
-        # Invoke callback if registered.
-        if 'callback' in params:
-            params['callback'](post)
-        item_params = dict(params, **post)
-        item_params['summary'] = truncate(post['content'])
-        item = render(item_layout, **item_params)
-        items.append(item)
+    item_base = dict(params)
+    derived = {'summary': lambda item_params: truncate(item_params['content'])}
+
+    def render_items():
+        for post in posts:
+            # Invoke callback if registered.
+            if 'callback' in item_base:
+                item_base['callback'](post)
+            item_params = dict(item_base, **post)
+            yield render_cached(item_layout, derived, **item_params)
 
     count = len(posts)
-    params['content'] = ''.join(items)
     params['count'] = count
     params['post_label'] = 'post' if count == 1 else 'posts'
     if 'import' in params:
@@ -244,10 +406,10 @@ def make_list(posts, dst, list_layout, item_layout, **params):
 
     dst_path = render(dst, **params)
     set_canonical_url(params, dst_path)
-    output = render(list_layout, **params)
 
     log('Rendering list => {} ...', dst_path)
-    fwrite(dst_path, output)
+    fwrite_stream(dst_path, render_stream(list_layout, render_items(),
+                                          **params))
 
 
 def make_tags(posts, dst,
@@ -256,34 +418,214 @@ def make_tags(posts, dst,
     """Generate tags page for a blog."""
     tag_map = collections.defaultdict(list)
     for post in posts:
-        item_params = dict(params, **post)
-        item = render(item_layout, **item_params)
-        tag = post['tag']
-        tag_map[tag].append(item)
+        tag_map[post['tag']].append(post)
+    item_base = dict(params)
+
+    def render_items(posts):
+        for post in posts:
+            item_params = dict(item_base, **post)
+            yield render_cached(item_layout, **item_params)
+
+    def render_tags(sections):
+        for tag_params, posts in sections:
+            yield from render_stream(tagl_layout, render_items(posts),
+                                     **tag_params)
 
     tag_tuples = []
-    for tag, items in tag_map.items():
-        tag_tuples.append((len(items), tag, items))
-    tag_tuples.sort(reverse=True)
+    for tag, tag_posts in tag_map.items():
+        tag_tuples.append((len(tag_posts), tag, tag_posts))
+    tag_tuples.sort(key=lambda x: x[:2], reverse=True)
 
     header = []
-    content = []
-    for count, tag, items in tag_tuples:
-        params['content'] = ''.join(items)
-        params['tag'] = tag
-        params['count'] = count
-        params['post_label'] = 'post' if count == 1 else 'posts'
-        params['tag_title'] = tag.title()
-        dst_path = render(dst, **params)
-        header.append(render(tagh_layout, **params))
-        content.append(render(tagl_layout, **params))
+    sections = []
+    for count, tag, tag_posts in tag_tuples:
+        tag_params = dict(params)
+        tag_params['tag'] = tag
+        tag_params['count'] = count
+        tag_params['post_label'] = 'post' if count == 1 else 'posts'
+        tag_params['tag_title'] = tag.title()
+        header.append(render(tagh_layout, **tag_params))
+        sections.append((tag_params, tag_posts))
 
     params['header'] = ''.join(header)
-    params['content'] = ''.join(content)
+    dst_path = render(dst, **params)
     set_canonical_url(params, dst_path)
 
     log('Rendering list => {} ...', dst_path)
-    fwrite(dst_path, render(tags_layout, **params))
+    fwrite_stream(dst_path, render_stream(tags_layout, render_tags(sections),
+                                          **params))
+
+
+# Related Posts
+# =============
+def tokenize(text):
+    """Return lowercase words in text after removing tags and placeholders."""
+    text = re.sub(r'{{.*?}}', ' ', text)
+    text = strip_tags(text)
+    return re.findall(r'[a-z][a-z0-9]+', text.lower())
+
+
+def tfidf_vectors(term_counts):
+    """Return L2-normalized TF-IDF vectors as dictionaries of weights."""
+    n = len(term_counts)
+    doc_freq = collections.Counter(t for counts in term_counts for t in counts)
+    vectors = []
+    for counts in term_counts:
+        vector = {}
+        for term, count in counts.items():
+            weight = (1 + math.log(count)) * math.log(n / doc_freq[term])
+            if weight > 0:
+                vector[term] = weight
+        norm = math.sqrt(sum(w * w for w in vector.values()))
+        vectors.append({t: w / norm for t, w in vector.items()})
+    return vectors
+
+
+def top_similar(vectors, k, block_size=256):
+    """Return indices of the k vectors most similar to each vector."""
+    try:
+        if _test == 'ImportError':
+            raise ImportError('Error forced by test')
+        import numpy
+    except ImportError:
+        return top_similar_sparse(vectors, k)
+
+    # Terms present in only one vector cannot contribute to similarity
+    # between two different vectors, so they are left out of the matrix.
+    doc_freq = collections.Counter(t for vector in vectors for t in vector)
+    terms = sorted(t for t, count in doc_freq.items() if count > 1)
+    columns = {t: i for i, t in enumerate(terms)}
+    matrix = numpy.zeros((len(vectors), len(terms)))
+    for row, vector in enumerate(vectors):
+        for term, weight in vector.items():
+            if term in columns:
+                matrix[row, columns[term]] = weight
+
+    # Compute similarities of a block of rows with all rows at a time.
+    result = []
+    for start in range(0, len(vectors), block_size):
+        scores = matrix[start:start + block_size] @ matrix.T
+        rows = numpy.arange(scores.shape[0])
+        scores[rows, rows + start] = 0
+        ranks = numpy.argsort(-scores, axis=1, kind='stable')[:, :k]
+        for row, ranked in zip(scores, ranks):
+            result.append([int(j) for j in ranked if row[j] > 0])
+    return result
+
+
+def top_similar_sparse(vectors, k):
+    """Return indices of the k vectors most similar to each vector."""
+    postings = collections.defaultdict(list)
+    for j, vector in enumerate(vectors):
+        for term, weight in vector.items():
+            postings[term].append((j, weight))
+
+    result = []
+    for i, vector in enumerate(vectors):
+        scores = collections.defaultdict(float)
+        for term, weight in vector.items():
+            for j, other_weight in postings[term]:
+                if j != i:
+                    scores[j] += weight * other_weight
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        result.append([j for j, score in ranked[:k] if score > 0])
+    return result
+
+
+def find_related_posts(posts, count):
+    """Return a dictionary that maps each post slug to related post slugs."""
+    # Word counts of unchanged posts are reused from the last build.
+    cache = read_cache('related')
+    old_terms = cache.get('terms', {})
+    terms = {}
+    for post in posts:
+        key = cache_key(post['content'])
+        entry = old_terms.get(post['slug'])
+        if entry is None or entry['key'] != key:
+            counts = collections.Counter(tokenize(post['content']))
+            entry = {'key': key, 'counts': counts}
+        terms[post['slug']] = entry
+
+    slugs = sorted(terms)
+    key = cache_key(count, [terms[slug]['key'] for slug in slugs])
+    if cache.get('key') == key:
+        related = cache['related']
+    else:
+        log('Finding related posts ...')
+        vectors = tfidf_vectors([terms[slug]['counts'] for slug in slugs])
+        related = {}
+        for slug, indices in zip(slugs, top_similar(vectors, count)):
+            related[slug] = [slugs[j] for j in indices]
+
+    write_cache('related', {'terms': terms, 'key': key, 'related': related})
+    return related
+
+
+def make_archive(posts, dst, index_dst,
+                 year_layout, archive_layout, yeari_layout, item_layout,
+                 **params):
+    """Generate an archive page for each year and an archive index page."""
+    year_map = collections.OrderedDict()
+    for post in sorted(posts, key=lambda x: x['date'], reverse=True):
+        year_map.setdefault(post['date'][:4], []).append(post)
+
+    def render_items(posts, item_base):
+        for post in posts:
+            yield render_cached(item_layout, **dict(item_base, **post))
+
+    years = []
+    for year, year_posts in year_map.items():
+        count = len(year_posts)
+        year_params = dict(params)
+        year_params['year'] = year
+        year_params['count'] = count
+        year_params['post_label'] = 'post' if count == 1 else 'posts'
+        year_params['title'] = 'Archive of {}'.format(year)
+        dst_path = render(dst, **year_params)
+        set_canonical_url(year_params, dst_path)
+
+        # A year page depends only on the listing details of its posts,
+        # so it is rendered again only when one of them changes.
+        key = cache_key(year_layout, item_layout, cache_params(year_params),
+                        [(post['slug'], post['title'], post['date'])
+                         for post in year_posts])
+        output = render_stream(year_layout,
+                               render_items(year_posts, params),
+                               **year_params)
+        if fwrite_cached(dst_path, key, output):
+            log('Rendering {} => {} ...', year, dst_path)
+        else:
+            log('Reusing {} => {} ...', year, dst_path)
+        years.append(render(yeari_layout, **year_params))
+
+    count = len(posts)
+    params['count'] = count
+    params['post_label'] = 'post' if count == 1 else 'posts'
+    params['title'] = 'Archive'
+    dst_path = render(index_dst, **params)
+    set_canonical_url(params, dst_path)
+
+    log('Rendering list => {} ...', dst_path)
+    fwrite_stream(dst_path, render_stream(archive_layout, years, **params))
+
+
+def find_neighbors(posts):
+    """Return previous and next posts of each post overall and in its tag."""
+    neighbors = {post['slug']: {} for post in posts}
+    last = None
+    last_in_tag = {}
+    for post in sorted(posts, key=lambda x: x['date']):
+        slug = post['slug']
+        if last is not None:
+            neighbors[slug]['prev'] = last
+            neighbors[last]['next'] = slug
+        last = slug
+        tag = post.get('tag')
+        if tag in last_in_tag:
+            neighbors[slug]['tag_prev'] = last_in_tag[tag]
+            neighbors[last_in_tag[tag]]['tag_next'] = slug
+        last_in_tag[tag] = slug
+    return neighbors
 
 
 def make_blog(src, page_layout, **params):
@@ -296,6 +638,13 @@ def make_blog(src, page_layout, **params):
     item_layout = fread('layout/blog/item.html')
     feed_xml = fread('layout/blog/feed.xml')
     item_xml = fread('layout/blog/item.xml')
+    related_layout = fread('layout/blog/related.html')
+    backlinks_layout = fread('layout/blog/backlinks.html')
+    year_layout = fread('layout/blog/year.html')
+    archive_layout = fread('layout/blog/archive.html')
+    yeari_layout = fread('layout/blog/yeari.html')
+    navlink_layout = fread('layout/blog/navlink.html').rstrip('\n')
+    prefetch_layout = fread('layout/blog/prefetch.html').rstrip('\n')
 
     blog_root = params['root']
     post_root = blog_root + '../'
@@ -304,27 +653,100 @@ def make_blog(src, page_layout, **params):
     post_layout = render(page_layout, content=post_layout)
     list_layout = render(page_layout, content=list_layout)
     tags_layout = render(page_layout, content=tags_layout)
+    year_layout = render(page_layout, content=year_layout)
+    archive_layout = render(page_layout, content=archive_layout)
 
-    # Read all posts.
+    # Find related posts among listed posts before rendering any post.
+    sources = [read_content(path) for path in glob.glob(src)]
+    post_map = {post['slug']: post for post in sources
+                if post.get('list') != 'no'}
+    related_map = find_related_posts(list(post_map.values()),
+                                     int(params['related_count']))
+
+    # Find posts that link to each post from their content.
     params['root'] = post_root
-    posts = make_pages(src, '_site/blog/{{ slug }}/index.html',
-                       post_layout, blog='blog', render='yes', **params)
+    source_map = {post['slug']: post for post in sources}
+    backlink_map = find_backlinks(sources, blog='blog', **params)
+
+    # Find neighbors of listed posts in date order and within each tag.
+    neighbor_map = find_neighbors(list(post_map.values()))
+    neighbor_url = '{{ root }}blog/{{ slug }}/{{ index }}'
+
+    def render_post_list(layout, slugs, post_map):
+        items = []
+        for slug in slugs:
+            item_params = dict(params, blog='blog', **post_map[slug])
+            items.append(render_cached(item_layout, **item_params))
+        return render(layout, content=''.join(items)) if items else ''
+
+    def set_links(content):
+        slug = content['slug']
+        content['content'] = link_comment_pages(
+            content['content'], int(params['comments_per_page']))
+        content['related'] = render_post_list(
+            related_layout, related_map.get(slug, []), post_map)
+        content['backlinks'] = render_post_list(
+            backlinks_layout, backlink_map.get(slug, []), source_map)
+
+        # Link to neighbors and prefetch the older post, which is the
+        # likely next page of a reader going through recent posts.
+        neighbors = neighbor_map.get(slug, {})
+        urls = {}
+        for name in ('prev', 'next', 'tag_prev', 'tag_next'):
+            if name in neighbors:
+                neighbor = post_map[neighbors[name]]
+                urls[name] = render(neighbor_url, slug=neighbor['slug'],
+                                    **params)
+                content[name + '_url'] = urls[name]
+                content[name + '_title'] = neighbor['title']
+
+        tag_title = content.get('tag', '').title()
+        labels = [
+            ('prev', 'prev', 'Previous'),
+            ('next', 'next', 'Next'),
+            ('tag_prev', 'prev', 'Previous in ' + tag_title),
+            ('tag_next', 'next', 'Next in ' + tag_title),
+        ]
+        links = []
+        for name, rel, label in labels:
+            # Skip tag neighbors that are also the overall neighbors.
+            if name in urls and urls[name] != urls.get(name[4:]):
+                links.append('\n  ' + render(navlink_layout, url=urls[name],
+                                              rel=rel, label=label))
+        content['post_links'] = ''.join(links)
+        content['prefetch'] = ''
+        if 'prev' in urls:
+            content['prefetch'] = '\n  ' + render(prefetch_layout,
+                                                  url=urls['prev'])
+
+    # Read all posts.
+    posts = make_pages(src, '{{ site_dir }}/blog/{{ slug }}/index.html',
+                       post_layout, blog='blog', render='yes',
+                       callback=set_links, **params)
     listed_posts = [post for post in posts if post.get('list') != 'no']
 
     # Create blog list page as the home page.
     params['root'] = './'
-    make_list(listed_posts, '_site/index.html',
+    make_list(listed_posts, '{{ site_dir }}/index.html',
               list_layout, item_layout,
               blog='blog', title="Susam's Blog", **params)
 
     # Create tag list page as the blog page.
     params['root'] = blog_root
-    make_tags(listed_posts, '_site/blog/index.html',
+    make_tags(listed_posts, '{{ site_dir }}/blog/index.html',
               tags_layout, tagh_layout, tagl_layout, item_layout,
               blog='blog', title="Susam's Blog", **params)
 
+    # Create archive pages for each year.
+    params['root'] = post_root
+    make_archive(listed_posts, '{{ site_dir }}/blog/{{ year }}/index.html',
+                 '{{ site_dir }}/blog/archive/index.html',
+                 year_layout, archive_layout, yeari_layout, item_layout,
+                 blog='blog', **params)
+
     # Create RSS feeds.
-    make_list(listed_posts, '_site/blog/rss.xml',
+    params['root'] = blog_root
+    make_list(listed_posts, '{{ site_dir }}/blog/rss.xml',
               feed_xml, item_xml,
               blog='blog', title="Susam's Blog", **params)
 
@@ -367,8 +789,20 @@ def read_comment(text, pos):
     return content, next_pos
 
 
+# Parsed comment files shared by all site variants generated in a run.
+_comment_cache = {}
+
+
 def read_post_comments(filename):
     """Read a list of comments from a comment file."""
+    if filename not in _comment_cache:
+        _comment_cache[filename] = parse_post_comments(filename)
+    slug, post_comments = _comment_cache[filename]
+    return slug, [dict(comment) for comment in post_comments]
+
+
+def parse_post_comments(filename):
+    """Parse a list of comments from a comment file."""
     # Read file content.
     text = fread(filename)
 
@@ -386,43 +820,108 @@ def read_post_comments(filename):
     return slug, sorted(post_comments, key=lambda x: x['date'])
 
 
-def make_comment_list(post, comments, dst,
-                      list_layout, item_layout, **params):
-    """Generate a comment page with a list of rendered comments."""
-    slug = post['slug']
+def comment_page_path(page, from_page):
+    """Return relative path to a comment page from another comment page."""
+    base = './' if from_page == 1 else '../../'
+    return base if page == 1 else base + 'page/{}/'.format(page)
 
-    count = len(comments)
 
-    items = []
-    for index, comment in enumerate(comments, 1):
-        item_params = dict(params, index=index, **comment)
-        item_params['count'] = count
-        item_params['comment_label'] = 'comment' if count == 1 else 'comments'
-        item_params['retrieved'] = ''
-        source_url = item_params.get('source')
-        if source_url is not None:
-            item_params['retrieved'] = (
-                '<div class="meta">(Retrieved from <a href="{}">{}</a>)</div>'
-                .format(source_url, source_url)
-            )
-        item = render(item_layout, **item_params)
-        items.append(item)
+def comment_pager(page, pages, pager_layout, link_layout, **params):
+    """Return navigation links for a comment page."""
+    link_layout = link_layout.rstrip('\n')
+    links = []
+    if page > 1:
+        links.append('\n  ' + render(link_layout, label='Older Comments',
+                                     url=comment_page_path(page - 1, page),
+                                     **params))
+    if page < pages:
+        links.append('\n  ' + render(link_layout, label='Newer Comments',
+                                     url=comment_page_path(page + 1, page),
+                                     **params))
+    return render(pager_layout, links=''.join(links), **params)
 
-    title = 'Comments on ' + post['title']
-    params['content'] = ''.join(items)
-    params['slug'] = slug
-    params['title'] = title
-    params['post_title'] = post['title']
-    dst_path = render(dst, **params)
-    set_canonical_url(params, dst_path)
 
-    # Inherit imports from post.
-    import_value = 'comment.css ' + post.get('import', '')
-    params['imports'] = head_content(import_value, params['root'])
+# Links to a numbered comment in post content, e.g. comments/{{ index }}#5.
+_COMMENT_LINK_RE = re.compile(r'(comments/)({{\s*index\s*}}#(\d+))')
 
-    log('Rendering {} => {} ...', slug, dst_path)
-    output = render(list_layout, **params)
-    fwrite(dst_path, output)
+
+def link_comment_pages(text, per_page):
+    """Point links to numbered comments at the page that shows them."""
+    def comment_link(match):
+        page = (int(match.group(3)) - 1) // per_page + 1
+        if page == 1:
+            return match.group(0)
+        return '{}page/{}/{}'.format(match.group(1), page, match.group(2))
+
+    if per_page <= 0:
+        return text
+    return _COMMENT_LINK_RE.sub(comment_link, text)
+
+
+def make_comment_list(post, comments, dst, page_dst,
+                      list_layout, item_layout, pager_layout, link_layout,
+                      **params):
+    """Generate comment pages with a list of rendered comments."""
+    slug = post['slug']
+
+    count = len(comments)
+    per_page = int(params.get('comments_per_page', 0))
+    if per_page <= 0 or count <= per_page:
+        per_page = max(count, 1)
+    pages = (count + per_page - 1) // per_page
+
+    # Comments are sorted oldest first, so a page boundary never moves
+    # and a new comment only changes the last page and the first page.
+    for page in range(1, pages + 1):
+        page_comments = comments[(page - 1) * per_page:page * per_page]
+        first = (page - 1) * per_page + 1
+
+        items = []
+        for index, comment in enumerate(page_comments, first):
+            item_params = dict(params, index=index, **comment)
+            if pages == 1:
+                item_params['position'] = '#{} of {} {}'.format(
+                    index, count, 'comment' if count == 1 else 'comments')
+            else:
+                item_params['position'] = '#{}'.format(index)
+            item_params['retrieved'] = ''
+            source_url = item_params.get('source')
+            if source_url is not None:
+                item_params['retrieved'] = (
+                    '<div class="meta">(Retrieved from <a href="{}">{}</a>)</div>'
+                    .format(source_url, source_url)
+                )
+            item = render(item_layout, **item_params)
+            items.append(item)
+
+        page_params = dict(params)
+        title = 'Comments on ' + post['title']
+        if page > 1:
+            title += ' (Page {})'.format(page)
+            page_params['root'] = params['root'] + '../../'
+        page_params['content'] = ''.join(items)
+        page_params['slug'] = slug
+        page_params['page'] = page
+        page_params['title'] = title
+        page_params['post_title'] = post['title']
+        page_params['post_path'] = '../' if page == 1 else '../../../'
+        page_params['pager'] = ''
+        if pages > 1:
+            page_params['pager'] = comment_pager(
+                page, pages, pager_layout, link_layout, first=first,
+                last=first + len(items) - 1, count=count,
+                index=params['index'])
+        dst_path = render(dst if page == 1 else page_dst, **page_params)
+        set_canonical_url(page_params, dst_path)
+
+        # Inherit imports from post.
+        import_value = 'comment.css ' + post.get('import', '')
+        page_params['imports'] = head_content(import_value,
+                                              page_params['root'])
+
+        log('Rendering {} => {} ...', slug, dst_path)
+        output = render(list_layout, **page_params)
+        fwrite(dst_path, output)
 
 
 def make_comments_none(post, dst, none_layout, **params):
@@ -447,9 +946,13 @@ def make_comments(src, posts, page_layout, **params):
     none_layout = fread('layout/comments/none.html')
     list_layout = fread('layout/comments/list.html')
     item_layout = fread('layout/comments/item.html')
+    pager_layout = fread('layout/comments/pager.html')
+    link_layout = fread('layout/comments/pagel.html')
     none_layout = render(page_layout, content=none_layout)
     list_layout = render(page_layout, content=list_layout)
-    dst = '_site/{{ blog }}/{{ slug }}/comments/index.html'
+    dst = '{{ site_dir }}/{{ blog }}/{{ slug }}/comments/index.html'
+    page_dst = ('{{ site_dir }}/{{ blog }}/{{ slug }}/comments/'
+                'page/{{ page }}/index.html')
 
     # Read all comments.
     comment_map = {}
@@ -461,8 +964,9 @@ def make_comments(src, posts, page_layout, **params):
     for post in posts:
         slug = post['slug']
         if slug in comment_map:
-            make_comment_list(post, comment_map[slug], dst,
-                              list_layout, item_layout, blog='blog', **params)
+            make_comment_list(post, comment_map[slug], dst, page_dst,
+                              list_layout, item_layout, pager_layout,
+                              link_layout, blog='blog', **params)
         else:
             make_comments_none(post, dst, none_layout, blog='blog', **params)
 
@@ -470,6 +974,16 @@ def make_comments(src, posts, page_layout, **params):
 
 _SECTION_RE = re.compile('\s*<!--\s*(note|quote)\s*-->\s*')
 
+# Tags allowed in reading posts in the order they appear in the listing.
+_READING_TAGS = collections.OrderedDict({
+    # tag: (title, singular_label, plural_label)
+    'non-fiction': ('Non-Fiction', 'book', 'books'),
+    'technical': ('Technical', 'book', 'books'),
+    'textbook': ('Textbooks', 'book', 'books'),
+    'paper': ('Papers', 'paper', 'papers'),
+    'fiction': ('Fiction', 'book', 'books'),
+})
+
 
 def set_parsed_reading_content(post):
     """Parse reading content into quotes and notes."""
@@ -504,37 +1018,63 @@ def set_reading_extra_meta(post):
     post['extra'] = ''.join(extra)
 
 
+def read_reading_post(src_path, books):
+    """Read reading post, reusing cached parse result if file is unchanged."""
+    # The date and slug of a book come from its file name.
+    key = cache_key(src_path, fread(src_path))
+    book = books.get(src_path)
+    if book is not None and book['key'] == key:
+        return book['post'], key
+
+    post = read_content(src_path)
+    set_parsed_reading_content(post)
+    set_reading_extra_meta(post)
+    books[src_path] = {'key': key, 'post': post}
+    return post, key
+
+
 def make_reading(src, page_layout, **params):
-    """Generate reading listing."""
-    tag_attrs = collections.OrderedDict({
-        # tag: (title, singular_label, plural_label)
-        'non-fiction': ('Non-Fiction', 'book', 'books'),
-        'technical': ('Technical', 'book', 'books'),
-        'textbook': ('Textbooks', 'book', 'books'),
-        'paper': ('Papers', 'paper', 'papers'),
-        'fiction': ('Fiction', 'book', 'books'),
-    })
+    """Generate reading listing with one page per tag."""
+    tag_attrs = _READING_TAGS
     # Read file content.
     read_layout = fread('layout/reading/read.html')
-    tagl_layout = fread('layout/reading/tagl.html')
+    tag_layout = fread('layout/reading/tag.html')
     item_layout = fread('layout/reading/tagi.html')
     tocl_layout = fread('layout/reading/tocl.html')
     toci_layout = fread('layout/reading/toci.html')
     read_layout = render(page_layout, content=read_layout)
+    tag_layout = render(page_layout, content=tag_layout)
+
+    # Parse results of unchanged files are reused from the last build.
+    cache = read_cache('reading')
+    books = {}
+    old_books = cache.get('books', {})
 
     tag_map = collections.defaultdict(list)
-    for src_path in glob.glob(src):
-        post = read_content(src_path)
-        set_parsed_reading_content(post)
-        set_reading_extra_meta(post)
+    for src_path in sorted(glob.glob(src)):
+        post, key = read_reading_post(src_path, old_books)
+        books[src_path] = old_books[src_path]
         tag = post['tag']
         if tag not in tag_attrs:
             msg = 'Unknown tag {!r} in {}'.format(tag, src_path)
             raise ValueError(msg)
-        tag_map[tag].append(post)
+        tag_map[tag].append((post, key))
+
+    def reading_item_params(post):
+        item_params = dict(params, **post)
+        quotes = ['<blockquote>\n{}</blockquote>\n'.format(quote)
+                  for quote in post['quote']]
+        item_params['quotes'] = ''.join(quotes)
+        item_params['notes'] = ''.join(post['note'])
+        item_params['quote_title'] = ('An Excerpt' if len(quotes) == 1 else
+                                      'Some Excerpts')
+        return item_params
+
+    def render_items(posts):
+        for post in posts:
+            yield render(item_layout, **reading_item_params(post))
 
     toc_list = []
-    tag_list = []
 
     for tag, (tag_title, singular_label, plural_label) in tag_attrs.items():
         # Ignore tags with no posts.
@@ -549,33 +1089,39 @@ def make_reading(src, page_layout, **params):
         tag_params['tag_label'] = (singular_label if count == 1 else
                                    plural_label)
 
-        toc_items = []
-        tag_items = []
-
-        posts = tag_map[tag]
-        posts = sorted(posts, key=lambda x: x['date'], reverse=True)
+        tag_posts = sorted(tag_map[tag], key=lambda x: x[0]['date'],
+                           reverse=True)
+        posts = [post for post, key in tag_posts]
+
+        toc_items = [render(toci_layout, **reading_item_params(post))
+                     for post in posts]
+        toc_list.append(render(tocl_layout, content=''.join(toc_items),
+                               **tag_params))
+
+        # Render tag page only if its posts, layouts or params changed.
+        tag_params['root'] = params['root'] + '../'
+        tag_params['title'] = 'My Reading Log: ' + tag_params['tag_title']
+        tag_params['imports'] = head_content('reading.css tex.js',
+                                             tag_params['root'])
+        dst_path = '{}/reading/{}/index.html'.format(params['site_dir'], tag)
+        set_canonical_url(tag_params, dst_path)
+        key = cache_key(tag_layout, item_layout, cache_params(tag_params),
+                        [key for post, key in tag_posts])
+        output = render_stream(tag_layout, render_items(posts), **tag_params)
+        if fwrite_cached(dst_path, key, output):
+            log('Rendering {} => {} ...', tag, dst_path)
+        else:
+            log('Reusing {} => {} ...', tag, dst_path)
 
-        for post in posts:
-            item_params = dict(params, **post)
-            quotes = ['<blockquote>\n{}</blockquote>\n'.format(quote)
-                      for quote in post['quote']]
-            item_params['quotes'] = ''.join(quotes)
-            item_params['notes'] = ''.join(post['note'])
-            item_params['quote_title'] = ('An Excerpt' if len(quotes) == 1 else
-                                          'Some Excerpts')
-            tag_items.append(render(item_layout, **item_params))
-            toc_items.append(render(toci_layout, **item_params))
-
-        toc_list.append(render(tocl_layout, content=''.join(toc_items), **tag_params))
-        tag_list.append(render(tagl_layout, content=''.join(tag_items), **tag_params))
+    write_cache('reading', {'books': books})
 
     read_params = dict(params)
-    read_params['content'] = ''.join(tag_list)
     read_params['toc'] = ''.join(toc_list)
-    read_params['imports'] = head_content('reading.css tex.js', params['root'])
+    read_params['imports'] = head_content('reading.css', params['root'])
 
-    dst_path = '_site/reading/index.html'
+    dst_path = params['site_dir'] + '/reading/index.html'
     set_canonical_url(read_params, dst_path)
+    log('Rendering list => {} ...', dst_path)
     output = render(read_layout, title='My Reading Log', **read_params)
     fwrite(dst_path, output)
 
@@ -594,7 +1140,7 @@ def make_text_dir(src, page_layout, **params):
     title = topic.title() + ' Files'
     dir_params = dict(params)
     dir_params['import'] = 'extra.css'
-    make_list(file_list, '_site/' + path + '/index.html',
+    make_list(file_list, params['site_dir'] + '/' + path + '/index.html',
               list_layout, item_layout, title=title, dirname=path,
               **dir_params)
 
@@ -610,31 +1156,315 @@ def make_music(src, page_layout, **params):
 
     def make_widget(content):
         widget_params = dict(music_params, **content)
-        widget = render(widget_layout, **widget_params)
+        widget = render_cached(widget_layout, **widget_params)
         content['widget'] = widget
 
     music_params = dict(params)
     music_params['import'] = 'music.css'
     music_params['root'] = params['root'] + '../'
     posts = make_pages(src,
-                       '_site/music/{{ slug }}/index.html',
+                       '{{ site_dir }}/music/{{ slug }}/index.html',
                        post_layout, blog='music', render='yes',
                        callback=make_widget, **music_params)
 
     music_params['root'] = params['root']
-    make_list(posts, '_site/music/index.html',
+    make_list(posts, '{{ site_dir }}/music/index.html',
               list_layout, item_layout, blog='music', title='Music',
               **music_params, callback=make_widget)
 
 
-def main():
-    """Generate website."""
-    # Create a new _site directory from scratch.
-    if os.path.isdir('_site'):
-        shutil.rmtree('_site')
-    shutil.copytree('static', '_site')
-
-    # Default parameters.
+# Links
+# =====
+_LINK_RE = re.compile(r'\s(?:href|src)="([^"]*)"')
+_ANCHOR_RE = re.compile(r'\s(?:id|name)="([^"]*)"')
+
+
+def extract_links(text):
+    """Return lists of link targets and anchor names in HTML text."""
+    return _LINK_RE.findall(text), _ANCHOR_RE.findall(text)
+
+
+def resolve_link(page_url, href):
+    """Return (path, fragment) of an internal link or None for others."""
+    if re.match(r'(?i)[a-z][a-z0-9+.-]*:|//', href):
+        return None
+    url = urllib.parse.urljoin(page_url, href)
+    path, _, fragment = url.partition('#')
+    path = urllib.parse.unquote(path.split('?', 1)[0])
+    return path, fragment
+
+
+def scan_links(site_dir):
+    """Return links and anchors of HTML pages, reusing unchanged scans."""
+    cache = read_cache('links')
+    pages = {}
+    pattern = os.path.join(site_dir, '**', '*.html')
+    for path in sorted(glob.glob(pattern, recursive=True)):
+        rel_path = os.path.relpath(path, site_dir).replace(os.sep, '/')
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = hashlib.sha1(data).hexdigest()
+        page = cache.get(rel_path)
+        if page is None or page['key'] != key:
+            links, anchors = extract_links(data.decode())
+            page = {'key': key, 'links': links, 'anchors': anchors}
+        pages[rel_path] = page
+    write_cache('links', pages)
+    return pages
+
+
+def link_url(path):
+    """Return URL path of a page without the index.html file name."""
+    if path == 'index.html' or path.endswith('/index.html'):
+        return path[:-len('index.html')]
+    return path
+
+
+def find_backlinks(posts, **params):
+    """Return a dictionary that maps post slugs to slugs linking to them."""
+    backlinks = collections.defaultdict(list)
+    for post in sorted(posts, key=lambda x: x['date'], reverse=True):
+        post_url = '/{}/{}/'.format(params['blog'], post['slug'])
+        text = render(post['content'], **dict(params, **post))
+        targets = set()
+        for href in extract_links(text)[0]:
+            target = resolve_link(post_url, href)
+            if target is not None and link_url(target[0]) != post_url:
+                targets.add(link_url(target[0]))
+        for target in targets:
+            match = re.match(r'^/{}/([^/]+)/$'.format(params['blog']),
+                             target)
+            if match:
+                backlinks[match.group(1)].append(post['slug'])
+    return backlinks
+
+
+def check_links(site_dir, action):
+    """Report internal links in site that do not resolve."""
+    pages = scan_links(site_dir)
+    broken = []
+
+    for rel_path, page in pages.items():
+        page_url = link_url('/' + rel_path)
+
+        for href in page['links']:
+            target = resolve_link(page_url, href)
+            if target is None:
+                continue
+            path, fragment = target
+
+            # Resolve target path to a file in the site.
+            target_path = path.lstrip('/')
+            fs_path = os.path.join(site_dir, target_path)
+            if os.path.isdir(fs_path):
+                target_path = (target_path.rstrip('/') + '/index.html'
+                               ).lstrip('/')
+            elif not os.path.isfile(fs_path):
+                broken.append((rel_path, href))
+                continue
+
+            target_page = pages.get(target_path)
+            if (fragment and target_page is not None and
+                    fragment not in target_page['anchors']):
+                broken.append((rel_path, href))
+
+    for rel_path, href in sorted(set(broken)):
+        log('{}: {}/{}: Broken link {!r}',
+            'ERROR' if action == 'error' else 'WARNING',
+            site_dir, rel_path, href)
+    if broken and action == 'error':
+        raise LookupError('Found {} broken links in {}'
+                          .format(len(broken), site_dir))
+
+
+# Redirects
+# =========
+# Nginx map of redirects kept in each site and excluded from the mirror.
+_REDIRECT_MAP = '_redirects.map'
+
+
+def read_redirects(filename, pages):
+    """Return a sorted list of (source, target) URL paths to redirect."""
+    redirects = []
+    for line in fread(filename).splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line:
+            source, target = line.split()
+            redirects.append((source, target))
+
+    # Pages declare old URL paths that should redirect to them in headers.
+    for page in pages:
+        for source in page.get('redirect_from', '').split():
+            redirects.append((source, '/' + page['site_path']))
+
+    sources = collections.Counter(source for source, target in redirects)
+    for source, count in sources.items():
+        if count > 1:
+            raise ValueError('Duplicate redirect for {!r}'.format(source))
+    return sorted(redirects)
+
+
+def make_redirect_map(redirects, dst_path):
+    """Generate Nginx map of redirect targets for inclusion in config."""
+    lines = ['# Generated by makesite.py. Do not edit.',
+             'map $uri $redirect_uri {']
+    for source, target in redirects:
+        lines.append('    {} {};'.format(source, target))
+    lines.append('}')
+    log('Rendering redirects => {} ...', dst_path)
+    fwrite(dst_path, '\n'.join(lines) + '\n')
+
+
+def make_redirect_pages(redirects, layout, **params):
+    """Generate pages that redirect browsers where server config is absent."""
+    for source, target in redirects:
+        path = source.lstrip('/')
+        if path == '' or path.endswith('/'):
+            path += 'index.html'
+        dst_path = os.path.join(params['site_dir'], path)
+        if os.path.exists(dst_path):
+            raise ValueError('Redirect {!r} overwrites {}'
+                             .format(source, dst_path))
+
+        depth = path.count('/')
+        page_params = dict(params)
+        page_params['target'] = '../' * depth + target.lstrip('/')
+        if target.endswith('/'):
+            page_params['target'] += params['index']
+        page_params['canonical_url'] = params['site_url'] + target.lstrip('/')
+
+        log('Rendering redirect {} => {} ...', source, dst_path)
+        fwrite(dst_path, render(layout, **page_params))
+
+
+# Output Optimization
+# ===================
+# Regions of HTML that must be left untouched by the minifier. Script and
+# style elements are minified separately; pre, code and textarea elements
+# and TeX read by MathJax (loaded by tex.js) are copied verbatim.
+_PROTECTED_RE = re.compile(r'(?is)<(pre|code|textarea)\b.*?</\1>'
+                           r'|<(script|style)\b([^>]*)>(.*?)</\2>'
+                           r'|\\\(.*?\\\)|\\\[.*?\\\]'
+                           r'|\\begin{([^}]*)}.*?\\end{\5}')
+
+_STYLESHEET_RE = re.compile(r'<link rel="stylesheet" href="([^"]+)">')
+
+
+def minify_css(text):
+    """Remove comments and redundant whitespace from CSS."""
+    text = re.sub(r'(?s)/\*.*?\*/', '', text)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r' ?([{};,>]) ?', r'\1', text)
+    text = text.replace(': ', ':').replace(';}', '}')
+    return text.strip()
+
+
+def minify_js(text):
+    """Remove indentation, blank lines and line comments from JavaScript."""
+    lines = [line.strip() for line in text.splitlines()]
+    lines = [line for line in lines if line and not line.startswith('//')]
+    return '\n'.join(lines)
+
+
+def minify_html(text):
+    """Collapse whitespace and remove comments outside protected regions."""
+    def minify_text(text):
+        text = re.sub(r'(?s)<!--(?!\[).*?-->', '', text)
+        text = re.sub(r'\s*\n\s*', '\n', text)
+        return re.sub(r'[ \t]+', ' ', text)
+
+    def minify_match(match):
+        tag, attrs, code = match.group(2, 3, 4)
+        if tag is None:
+            return match.group(0)
+        code = minify_css(code) if tag.lower() == 'style' else minify_js(code)
+        return '<{}{}>{}</{}>'.format(tag, attrs, code, tag)
+
+    parts = []
+    pos = 0
+    for match in _PROTECTED_RE.finditer(text):
+        parts.append(minify_text(text[pos:match.start()]))
+        parts.append(minify_match(match))
+        pos = match.end()
+    parts.append(minify_text(text[pos:]))
+    return ''.join(parts).strip() + '\n'
+
+
+def inline_css(text, page_path, limit, css_cache):
+    """Replace links to small local stylesheets with inline style elements."""
+    def inline(match):
+        href = match.group(1)
+        if '://' in href or href.startswith('/'):
+            return match.group(0)
+        css_path = os.path.join(os.path.dirname(page_path), href)
+        css_path = os.path.normpath(css_path)
+        if css_path not in css_cache:
+            css = None
+            if os.path.isfile(css_path):
+                css = minify_css(fread(css_path))
+            css_cache[css_path] = css
+        css = css_cache[css_path]
+        if css is None or len(css.encode()) > limit:
+            return match.group(0)
+        return '<style>{}</style>'.format(css)
+
+    return _STYLESHEET_RE.sub(inline, text)
+
+
+def optimize_file(path, optimizer):
+    """Rewrite file with optimized content and return number of bytes saved."""
+    text = fread(path)
+    output = optimizer(text)
+    saved = len(text.encode()) - len(output.encode())
+    if output != text:
+        fwrite(path, output)
+    return saved
+
+
+def optimize_site(site_dir, params):
+    """Inline small stylesheets and minify HTML, CSS and JS in site."""
+    minify = params.get('minify') == 'yes'
+    limit = int(params.get('inline_css_limit', 0))
+    css_cache = {}
+    total_inlined = 0
+    total = 0
+
+    # Inlining adds bytes to pages and minifying removes bytes, so the
+    # two are counted separately to show what each stage contributes.
+    pattern = os.path.join(site_dir, '**', '*.html')
+    for path in sorted(glob.glob(pattern, recursive=True)):
+        text = output = fread(path)
+        if limit > 0:
+            output = inline_css(output, path, limit, css_cache)
+        inlined = len(output.encode()) - len(text.encode())
+        if minify:
+            saved = len(output.encode())
+            output = minify_html(output)
+            saved -= len(output.encode())
+        else:
+            saved = 0
+        if output != text:
+            fwrite(path, output)
+        log('Optimizing {} => {} bytes inlined, {} bytes saved ...',
+            path, inlined, saved)
+        total_inlined += inlined
+        total += saved
+
+    # Minify stylesheets and scripts only after they have been inlined.
+    if minify:
+        for ext, optimizer in (('css', minify_css), ('js', minify_js)):
+            pattern = os.path.join(site_dir, ext, '*.' + ext)
+            for path in sorted(glob.glob(pattern)):
+                saved = optimize_file(path, optimizer)
+                log('Optimizing {} => {} bytes saved ...', path, saved)
+                total += saved
+
+    log('Optimized {} => {} bytes inlined, {} bytes saved by minifying',
+        site_dir, total_inlined, total)
+
+
+def default_params():
+    """Return default parameters updated with params.json if it exists."""
     params = {
         'base_path': '',
         'subtitle': ' - Susam Pal',
@@ -642,18 +1472,69 @@ def main():
         'site_url': 'https://susam.in/',
         'current_year': datetime.datetime.now().year,
         'imports': '',
+        'prefetch': '',
         'index': '',
+        'minify': 'no',
+        'inline_css_limit': 0,
+        'comments_per_page': 0,
+        'related_count': 3,
+        'link_check': 'warn',
+        'source_url': 'https://github.com/susam/susam.in',
+        'mirror_url': 'https://susam.github.io/',
     }
 
     # If params.json exists, load it.
     if os.path.isfile('params.json'):
         params.update(json.loads(fread('params.json')))
 
+    return params
+
+
+def main(variants=(('_site', {}),)):
+    """Generate website for each (site directory, params) variant."""
+    params = default_params()
     page_layout = fread('layout/page.html')
+    start_time = time.time()
+    _fragments.update(read_cache('fragments'))
+
+    # Content files are parsed only once and shared by all variants.
+    for site_dir, variant_params in variants:
+        log('Generating {} ...', site_dir)
+        make_site(site_dir, page_layout, **dict(params, **variant_params))
+
+    write_cache('fragments', _used_fragments)
+    prune_cached(start_time)
+
+
+def check_site_dir(site_dir):
+    """Ensure that site directory can be deleted without losing sources."""
+    path = os.path.realpath(site_dir)
+    sources = [os.path.realpath(name)
+               for name in ('content', 'layout', 'static', '.git')]
+    if os.path.join(os.path.realpath('.'), '').startswith(
+            os.path.join(path, '')):
+        raise ValueError('Output directory {!r} contains the source '
+                         'directory'.format(site_dir))
+    for src_path in sources:
+        if os.path.join(path, '').startswith(os.path.join(src_path, '')):
+            raise ValueError('Output directory {!r} is in source directory '
+                             '{!r}'.format(site_dir, src_path))
+
+
+def make_site(site_dir, page_layout, **params):
+    """Generate website in the specified directory."""
+    # Create a new site directory from scratch.
+    check_site_dir(site_dir)
+    if os.path.isdir(site_dir):
+        shutil.rmtree(site_dir)
+    shutil.copytree('static', site_dir)
+
+    params['site_dir'] = site_dir
 
     params['root'] = '../'
-    make_pages('content/[!_]*.html', '_site/{{ slug }}/index.html',
-               page_layout, render='yes', **params)
+    pages = make_pages('content/[!_]*.html',
+                       '{{ site_dir }}/{{ slug }}/index.html',
+                       page_layout, render='yes', **params)
 
     # Blog.
     params['root'] = '../'
@@ -678,6 +1559,215 @@ def main():
 
     #make_licenses('content/licenses/*.html', page_layout, **params)
 
+    # Redirects.
+    redirects = read_redirects('content/_redirects.txt', pages + posts)
+    make_redirect_pages(redirects, fread('layout/redirect.html'), **params)
+
+    # The map is kept with the site so that it is released and rolled
+    # back along with the pages it redirects to.
+    make_redirect_map(redirects, site_dir + '/' + _REDIRECT_MAP)
+
+    # Report broken links unless link checking is disabled.
+    if params['link_check'] != 'no':
+        check_links(site_dir, params['link_check'])
+
+    # Inline stylesheets and minify output if requested in params.json.
+    if params['minify'] == 'yes' or int(params['inline_css_limit']) > 0:
+        optimize_site(site_dir, params)
+
+
+# Releases
+# ========
+def list_releases(releases_dir):
+    """Return release directories sorted from oldest to newest."""
+    if not os.path.isdir(releases_dir):
+        return []
+    # Names beginning with a dot are releases still being generated.
+    return [os.path.join(releases_dir, name)
+            for name in sorted(os.listdir(releases_dir))
+            if not name.startswith('.')]
+
+
+def source_revision():
+    """Return abbreviated Git revision of the website source."""
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             check=True, universal_newlines=True).stdout
+        return rev.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'norev'
+
+
+def new_release_dir(releases_dir):
+    """Return path for a new release named after time and Git revision."""
+    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    return os.path.join(releases_dir, timestamp + '-' + source_revision())
+
+
+def link_unchanged_files(release_dir, prev_dir):
+    """Replace files identical to previous release files with hardlinks."""
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(release_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            prev_path = os.path.join(prev_dir,
+                                     os.path.relpath(path, release_dir))
+            if (os.path.isfile(prev_path) and
+                    filecmp.cmp(path, prev_path, shallow=False)):
+                tmp_path = path + '.tmp'
+                os.link(prev_path, tmp_path)
+                os.replace(tmp_path, path)
+                count += 1
+    return count
+
+
+def flip_live_link(live_link, release_dir):
+    """Atomically point live symlink to release directory."""
+    # Move a live directory generated by older versions of this script
+    # out of the way. This is the only step that is not atomic, and it
+    # happens only once.
+    if os.path.isdir(live_link) and not os.path.islink(live_link):
+        releases_dir = os.path.dirname(release_dir)
+        os.rename(live_link, os.path.join(releases_dir, '0-' + live_link))
+
+    target = os.path.relpath(release_dir,
+                             os.path.dirname(os.path.abspath(live_link)))
+    tmp_link = live_link + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, live_link)
+    log('Publishing {} => {} ...', release_dir, live_link)
+
+
+def prune_releases(releases_dir, live_link, keep):
+    """Remove all but the newest releases and the live release."""
+    live_dir = os.path.realpath(live_link)
+    releases = list_releases(releases_dir)
+    for release_dir in releases[:max(len(releases) - keep, 0)]:
+        if os.path.realpath(release_dir) != live_dir:
+            log('Removing release {} ...', release_dir)
+            shutil.rmtree(release_dir)
+
+
+def release(releases_dir, live_link, keep):
+    """Generate website as a new release and publish it."""
+    prev_dir = os.path.realpath(live_link)
+    release_dir = new_release_dir(releases_dir)
+
+    # Generate the release under a temporary name so that a failed build
+    # never appears as a release that can be published or rolled back to.
+    tmp_dir = os.path.join(releases_dir,
+                           '.' + os.path.basename(release_dir) + '.tmp')
+    try:
+        main([(tmp_dir, {})])
+        if os.path.isdir(prev_dir):
+            count = link_unchanged_files(tmp_dir, prev_dir)
+            log('Linked {} unchanged files from {} ...', count, prev_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    os.rename(tmp_dir, release_dir)
+    flip_live_link(live_link, release_dir)
+    prune_releases(releases_dir, live_link, keep)
+
+
+def rollback(releases_dir, live_link):
+    """Publish the release preceding the live release."""
+    live_dir = os.path.realpath(live_link)
+    releases = [os.path.realpath(x) for x in list_releases(releases_dir)]
+    if live_dir not in releases or releases.index(live_dir) == 0:
+        raise LookupError('Cannot find release older than ' + live_dir)
+    flip_live_link(live_link, releases[releases.index(live_dir) - 1])
+
+
+# Mirror
+# ======
+def git_output(repo, *args):
+    """Run Git command on repository and return its output."""
+    return subprocess.run(['git', '--git-dir', repo] + list(args),
+                          stdout=subprocess.PIPE, check=True).stdout
+
+
+def git_blob_name(data):
+    """Return the name of the Git blob object for data."""
+    header = 'blob {}\0'.format(len(data)).encode()
+    return hashlib.sha1(header + data).hexdigest()
+
+
+def mirror_tree(repo, ref):
+    """Return a dictionary that maps file paths to blob names in ref."""
+    tree = {}
+    for entry in git_output(repo, 'ls-tree', '-r', '-z', ref).split(b'\0'):
+        if entry:
+            meta, path = entry.split(b'\t', 1)
+            tree[path.decode()] = meta.split()[2].decode()
+    return tree
+
+
+def fast_import_data(data):
+    """Return data command for Git fast-import."""
+    return 'data {}\n'.format(len(data)).encode() + data + b'\n'
+
+
+def publish_mirror(site_dir, repo, branch='master'):
+    """Commit files that changed since the last mirror commit to repo."""
+    # Refuse to publish a missing or empty site as deletion of all files.
+    if not any(filenames for _, _, filenames in os.walk(site_dir)):
+        raise LookupError('Cannot find files to publish in ' + site_dir)
+
+    params = default_params()
+    params['rev'] = source_revision()
+    ref = 'refs/heads/' + branch
+    has_ref = subprocess.run(['git', '--git-dir', repo, 'rev-parse',
+                              '--verify', '-q', ref],
+                             stdout=subprocess.DEVNULL).returncode == 0
+    old_tree = mirror_tree(repo, ref) if has_ref else {}
+
+    # Map each mirror file path to a function that returns its content.
+    readme = render(fread('layout/mirror/README.md'), **params).encode()
+    sources = {'README.md': lambda: readme}
+    for dirpath, dirnames, filenames in os.walk(site_dir):
+        for filename in filenames:
+            src_path = os.path.join(dirpath, filename)
+            path = os.path.relpath(src_path, site_dir).replace(os.sep, '/')
+            if path == _REDIRECT_MAP:
+                continue
+            sources[path] = (lambda src_path=src_path:
+                             open(src_path, 'rb').read())
+
+    # Compare blob names with the last commit to find changed files.
+    changed = [path for path in sorted(sources)
+               if old_tree.get(path) != git_blob_name(sources[path]())]
+    deleted = sorted(set(old_tree) - set(sources))
+    if not changed and not deleted:
+        log('Nothing to publish to {}', repo)
+        return
+
+    # Stream only the changed files into a commit on top of the last one.
+    ident = git_output(repo, 'var', 'GIT_COMMITTER_IDENT').strip()
+    message = 'Generated from {} - {}\n'.format(params['source_url'],
+                                                params['rev'])
+    proc = subprocess.Popen(['git', '--git-dir', repo, 'fast-import',
+                             '--quiet'], stdin=subprocess.PIPE)
+    proc.stdin.write(b'commit ' + ref.encode() + b'\n')
+    proc.stdin.write(b'committer ' + ident + b'\n')
+    proc.stdin.write(fast_import_data(message.encode()))
+    if has_ref:
+        proc.stdin.write(b'from ' + ref.encode() + b'^0\n')
+    for path in deleted:
+        proc.stdin.write('D {}\n'.format(path).encode())
+    for path in changed:
+        proc.stdin.write('M 100644 inline {}\n'.format(path).encode())
+        proc.stdin.write(fast_import_data(sources[path]()))
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise RuntimeError('Cannot import commit into ' + repo)
+
+    log('Published {} changed and {} deleted files to {} ...',
+        len(changed), len(deleted), repo)
+
 
 # Test parameter to be set temporarily by unit tests.
 _test = None
@@ -699,6 +1789,117 @@ def checks():
             raise LookupError(msg)
 
 
+# Content Checks
+# ==============
+# Regular expressions for rules that apply to each line of content.
+_LINE_CHECKS = [
+    (re.compile(r'\\\)(?!th|-|</a>|\)|:|\s|$)'),
+     'Punctuation must go inside inline-math'),
+    (re.compile(r'(?:th|-|</h[1-6]>|:) \\\)'),
+     'Unexpected space before end of inline-math'),
+    (re.compile(r'<h1(?!><a href="\./">)'),
+     'Page heading must be a hyperlink to itself'),
+    (re.compile(r'^(?!.*dixit:).*<h[2-6](?! id="[^"]*"><a)'),
+     'Section heading must be a hyperlink to itself'),
+]
+
+
+def check_content(path):
+    """Check a content file and return a list of diagnostics."""
+    diagnostics = []
+    text = fread(path)
+
+    for lineno, line in enumerate(text.splitlines(), 1):
+        for regex, msg in _LINE_CHECKS:
+            if regex.search(line):
+                diagnostics.append((path, lineno, msg))
+
+    for key, val, end in read_headers(text):
+        lineno = text.count('\n', 0, text.rfind(key, 0, end)) + 1
+        if key == 'import':
+            try:
+                head_content(val, '')
+            except ValueError as e:
+                diagnostics.append((path, lineno, str(e)))
+        elif key == 'tag' and path.startswith('content/reading/'):
+            if val not in _READING_TAGS:
+                msg = 'Unknown tag {!r}'.format(val)
+                diagnostics.append((path, lineno, msg))
+
+    return diagnostics
+
+
+def check_site():
+    """Check all content files and return a list of diagnostics."""
+    paths = sorted(glob.glob('content/**/*.html', recursive=True))
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        results = executor.map(check_content, paths)
+    diagnostics = [d for result in results for d in result]
+
+    # For each comment file, there must exist a post file.
+    posts = set(os.path.basename(x) for x in glob.glob('content/blog/*.html'))
+    for path in sorted(glob.glob('content/comments/*.html')):
+        if os.path.basename(path) not in posts:
+            diagnostics.append((path, 1, 'Cannot find post for comment file'))
+
+    # Current year must be present in footer.
+    year = datetime.datetime.now().year
+    footer = '&copy; 2005-{} Susam Pal'.format(year)
+    text = fread('static/cv.html')
+    if footer not in text:
+        lineno = text.count('\n', 0, max(text.find('&copy;'), 0)) + 1
+        msg = 'Cannot find footer {!r}'.format(footer)
+        diagnostics.append(('static/cv.html', lineno, msg))
+
+    # Report diagnostics of each file from top to bottom.
+    diagnostics.sort(key=lambda x: x[:2])
+    for path, lineno, msg in diagnostics:
+        log('{}:{}: {}', path, lineno, msg)
+    return diagnostics
+
+
 if __name__ == '__main__':
-    checks()
-    main()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output', default='_site',
+                        help='output directory (default: _site)')
+    parser.add_argument('--variant', nargs=2, action='append',
+                        metavar=('DIR', 'PARAMS'),
+                        help='generate a variant of the website in DIR '
+                             'with PARAMS (a JSON object) overriding '
+                             'params.json; may be repeated, and if '
+                             'specified, --output is ignored')
+    parser.add_argument('--release', action='store_true',
+                        help='generate website in a new directory in '
+                             '_releases and point _live to it')
+    parser.add_argument('--rollback', action='store_true',
+                        help='point _live to the previous release')
+    parser.add_argument('--keep', type=int, default=5,
+                        help='number of releases to keep (default: 5)')
+    parser.add_argument('--check', action='store_true',
+                        help='check content files and exit')
+    parser.add_argument('--mirror', nargs=2, metavar=('DIR', 'REPO'),
+                        help='after generating the website, commit files '
+                             'changed in DIR, the output directory or a '
+                             'variant directory, to Git repository REPO')
+    args = parser.parse_args()
+
+    variants = [(args.output, {})]
+    if args.variant:
+        variants = [(site_dir, json.loads(variant_params))
+                    for site_dir, variant_params in args.variant]
+    if args.mirror and args.mirror[0] not in [v[0] for v in variants]:
+        parser.error('argument --mirror: {!r} is not a generated directory'
+                     .format(args.mirror[0]))
+
+    if args.check:
+        sys.exit(1 if check_site() else 0)
+    elif args.rollback:
+        rollback('_releases', '_live')
+    elif args.release:
+        checks()
+        release('_releases', '_live', args.keep)
+    else:
+        checks()
+        main(variants)
+        if args.mirror:
+            publish_mirror(*args.mirror)